@@ -3,20 +3,16 @@
 from __future__ import (unicode_literals, division, absolute_import, print_function)
 
 import argparse
-import imp
 import os
 import platform
 import re
 import shutil
 import sys
 import traceback
+import types
 
 from calibre.constants import (config_dir, get_version)
 from calibre.customize.conversion import (OutputFormatPlugin, OptionRecommendation)
-from calibre.ebooks.conversion import ConversionUserFeedBack
-from calibre.ebooks.conversion.plugins.epub_output import EPUBOutput
-from calibre.ebooks.oeb.base import OPF as OPFNS
-from calibre.ebooks.metadata.opf2 import OPF
 from calibre.utils.config_base import tweaks
 from calibre.utils.logging import Log
 
@@ -25,9 +21,30 @@ __copyright__ = "2021, John Howell <jhowell@acm.org>"
 
 
 PREPARED_FILE_SAVE_DIR = None
-ASIN_RE = r"^B[0-9A-Z]{9}$"
+# match() anchors at the start and \Z at the very end, giving full match semantics on all Python versions
+ASIN_RE = re.compile(r"B[0-9A-Z]{9}\Z")
+ASIN_IDTYPE_RES = [re.compile(r"mobi-asin\Z"), re.compile(r"amazon.*\Z"), re.compile(r"asin\Z")]     # in priority order
 AUTO_PAGES = "(auto)"           # fake name for automatic page number generation, instead of a lookup name
 TIMEOUT = 15 * 60               # in seconds
+MAX_JOB_LOG_MESSAGES = 1024     # first errors and warnings retained for the job summary, later ones are only counted
+
+CLI_INPUT_EXTS = [".epub", ".opf", ".mobi", ".doc", ".docx", ".kpf", ".kfx-zip"]
+CLI_ALLOWED_EXTS = frozenset(CLI_INPUT_EXTS)
+CLI_KPF_EXTS = frozenset([".kpf", ".kfx-zip"])
+CLI_EXT_CHOICES = ", ".join(CLI_INPUT_EXTS[:-1] + ["or " + CLI_INPUT_EXTS[-1]])
+
+EPUB_OPTION_OVERRIDES = {       # values required for currently known EPUB Output plugin options
+    "extract_to": None,
+    "dont_split_on_page_breaks": False,
+    "flow_size": 0,
+    "no_default_epub_cover": False,
+    "no_svg_cover": False,
+    "preserve_cover_aspect_ratio": True,
+    "epub_flatten": False,
+    "epub_inline_toc": False,
+    "epub_toc_at_end": False,
+    "toc_title": None,
+    }
 
 if sys.version_info[0] == 2:
     str = type("")
@@ -40,6 +57,7 @@ class KFXOutput(OutputFormatPlugin):
     version = (1, 56, 0)
     minimum_calibre_version = (2, 0, 0)                 # required for apsw with sqlite >= 3.8.2
     supported_platforms = ["windows", "osx", "linux"]
+    epub_option_defaults = None     # recommended values of EPUB Output plugin options by name
 
     options = {
         OptionRecommendation(
@@ -77,19 +95,34 @@ class KFXOutput(OutputFormatPlugin):
             help="Include Kindle Previewer quality report messages in the conversion log."),
     }
 
-    recommendations = EPUBOutput.recommendations
-
     def __init__(self, *args, **kwargs):
         self.cli = False
         OutputFormatPlugin.__init__(self, *args, **kwargs)
+        self.version_str = "%d.%d.%d" % self.version
 
-        self.epub_output_plugin = EPUBOutput(*args, **kwargs)
+        # the EPUB Output plugin is only needed during conversion, so it is created on first use
+        self.plugin_args = (args, kwargs)
+        self.epub_output_plugin_ = None
 
         self.resources = self.load_resources(["kfx.png", "plugin_widget.py"])
         self.load_kfx_icon()
         self.load_configuration_widget()
         self.init_embedded_plugins()
 
+    @property
+    def recommendations(self):
+        from calibre.ebooks.conversion.plugins.epub_output import EPUBOutput
+        return EPUBOutput.recommendations
+
+    @property
+    def epub_output_plugin(self):
+        if self.epub_output_plugin_ is None:
+            from calibre.ebooks.conversion.plugins.epub_output import EPUBOutput
+            args, kwargs = self.plugin_args
+            self.epub_output_plugin_ = EPUBOutput(*args, **kwargs)
+
+        return self.epub_output_plugin_
+
     def load_kfx_icon(self):
         # calibre does not include an icon for KFX format
 
@@ -119,11 +152,12 @@ class KFXOutput(OutputFormatPlugin):
             return      # not running GUI so no need to install this
 
         mod_name = "calibre.gui2.convert.kfx_output"        # expected name of module containing PluginWidget
-        mod_src = self.resources["plugin_widget.py"]
+        if mod_name in sys.modules:
+            return      # already installed by a previous instance
 
         try:
-            mod = imp.new_module(mod_name)
-            exec(mod_src, mod.__dict__)         # compile source
+            mod = types.ModuleType(mod_name.encode("ascii") if sys.version_info[0] == 2 else mod_name)
+            exec(compile(self.resources["plugin_widget.py"], "plugin_widget.py", "exec"), mod.__dict__)
             sys.modules[mod_name] = mod         # prevent any future import attempt
 
         except Exception:
@@ -135,6 +169,10 @@ class KFXOutput(OutputFormatPlugin):
         return PluginWidget(parent, get_option_by_name, get_option_help, db, book_id)
 
     def convert(self, oeb_book, output, input_plugin, opts, log):
+        from calibre.ebooks.conversion.plugins.epub_output import EPUBOutput
+        from calibre.ebooks.metadata.opf2 import OPF
+        from calibre.ebooks.oeb.base import OPF as OPFNS
+
         self.report_version(log)
 
         #for mivals in oeb_book.metadata.items.values():
@@ -149,16 +187,15 @@ class KFXOutput(OutputFormatPlugin):
         asin = None
 
         if not tweaks.get("kfx_output_ignore_asin_metadata", False):
-            for idre in ["^mobi-asin$", "^amazon.*$", "^asin$"]:
-                for ident in oeb_book.metadata["identifier"]:
-                    idtype = ident.get(OPFNS("scheme"), "").lower()
-                    if re.match(idre, idtype) and re.match(ASIN_RE, ident.value):
-                        asin = ident.value
-                        log.info("Found ASIN metadata %s: %s" % (idtype, asin))
-                        break
+            scheme_key = OPFNS("scheme")
+            identifiers = [(ident.get(scheme_key, "").lower(), ident.value) for ident in oeb_book.metadata["identifier"]]
+
+            idtype, asin = next((
+                    (idtype, value) for idre in ASIN_IDTYPE_RES for idtype, value in identifiers
+                    if idre.match(idtype) and ASIN_RE.match(value)), (None, None))
 
-                if asin:
-                    break
+            if asin:
+                log.info("Found ASIN metadata %s: %s" % (idtype, asin))
 
         #with open(opts.read_metadata_from_opf, "rb") as opff:
         #    log.info("opf: %s" % opff.read())
@@ -186,21 +223,12 @@ class KFXOutput(OutputFormatPlugin):
         #log.info("oeb_book contains %d pages" % len(oeb_book.pages.pages))
         #log.info("options: %s" % str(opts.__dict__))
 
-        # set default values for options expected by the EPUB Output plugin
-        for optrec in EPUBOutput.options:
-            setattr(opts, optrec.option.name, optrec.recommended_value)
-
-        # override currently known EPUB Output plugin options
-        opts.extract_to = None
-        opts.dont_split_on_page_breaks = False
-        opts.flow_size = 0
-        opts.no_default_epub_cover = False
-        opts.no_svg_cover = False
-        opts.preserve_cover_aspect_ratio = True
-        opts.epub_flatten = False
-        opts.epub_inline_toc = False
-        opts.epub_toc_at_end = False
-        opts.toc_title = None
+        if KFXOutput.epub_option_defaults is None:
+            KFXOutput.epub_option_defaults = {optrec.option.name: optrec.recommended_value for optrec in EPUBOutput.options}
+
+        # set default values for options expected by the EPUB Output plugin, then override currently known options
+        vars(opts).update(KFXOutput.epub_option_defaults)
+        vars(opts).update(EPUB_OPTION_OVERRIDES)
 
         epub_filename = self.temporary_file(".epub").name
         self.epub_output_plugin.convert(oeb_book, epub_filename, input_plugin, opts, log)  # convert input format to EPUB
@@ -211,7 +239,11 @@ class KFXOutput(OutputFormatPlugin):
                 os.makedirs(PREPARED_FILE_SAVE_DIR)
 
             prepared_file_path = os.path.join(PREPARED_FILE_SAVE_DIR, os.path.basename(epub_filename))
-            shutil.copyfile(epub_filename, prepared_file_path)
+            try:
+                os.link(epub_filename, prepared_file_path)      # avoid copying the data when possible
+            except Exception:
+                shutil.copyfile(epub_filename, prepared_file_path)
+
             log.warning("Saved conversion input file: %s" % prepared_file_path)
 
         self.convert_using_previewer(
@@ -224,9 +256,6 @@ class KFXOutput(OutputFormatPlugin):
         self.report_version(log)
         log.info("")
 
-        allowed_exts = [".epub", ".opf", ".mobi", ".doc", ".docx", ".kpf", ".kfx-zip"]
-        ext_choices = ", ".join(allowed_exts[:-1] + ["or " + allowed_exts[-1]])
-
         parser = argparse.ArgumentParser(prog='calibre-debug -r "KFX Output" --', description="Convert e-book to KFX format")
         parser.add_argument("-a", "--asin", action="store", help="Optional ASIN to assign to the book")
         parser.add_argument("-c", "--clean", action="store_true", help="Save the input file cleaned for conversion to KFX")
@@ -236,12 +265,12 @@ class KFXOutput(OutputFormatPlugin):
         parser.add_argument("-q", "--quality", action="store_true", help="Include Kindle Previewer quality report in log")
         parser.add_argument("-t", "--timeout", action="store_true", help="Stop conversions lasting over 15 minutes")
         parser.add_argument("-l", "--logs", action="store_true", help="Show log files produced during conversion")
-        parser.add_argument("infile", help="Pathname of the %s file to be converted" % ext_choices)
+        parser.add_argument("infile", help="Pathname of the %s file to be converted" % CLI_EXT_CHOICES)
         parser.add_argument("outfile", nargs="?", help="Optional pathname of the resulting .kfx file")
         args = parser.parse_args(argv[1:])
 
         input = book_name = args.infile
-        intype = os.path.splitext(input)[1]
+        input_root, intype = os.path.splitext(input)
 
         if not os.path.isfile(input):
             raise Exception("Input file does not exist: %s" % input)
@@ -249,19 +278,19 @@ class KFXOutput(OutputFormatPlugin):
         if args.outfile:
             output = args.outfile
         else:
-            output = os.path.join(os.path.dirname(input), os.path.splitext(os.path.basename(input))[0] + ".kfx")
+            output = input_root + ".kfx"
 
         if not output.endswith(".kfx"):
             raise Exception("Output file must have .kfx extension")
 
-        if intype in [".kpf", ".kfx-zip"]:
+        if intype in CLI_KPF_EXTS:
             self.convert_from_kpf_or_zip(log, book_name, input, args.asin, args.doc, args.pages, intype == ".kpf", output)
-        elif intype in allowed_exts:
+        elif intype in CLI_ALLOWED_EXTS:
             self.convert_using_previewer(
                     log, book_name, input, args.asin, args.doc, args.pages, args.logs,
                     args.clean, args.timeout, args.quality, output)
         else:
-            raise Exception("Input file must be %s" % ext_choices)
+            raise Exception("Input file must be %s" % CLI_EXT_CHOICES)
 
     def report_version(self, log):
         try:
@@ -269,24 +298,26 @@ class KFXOutput(OutputFormatPlugin):
         except Exception:
             platform_info = sys.platform     # handle failure to retrieve platform seen on linux
 
-        log.info("Software versions: %s %s, calibre %s, %s" % (self.name, ".".join([str(v) for v in self.version]),
+        log.info("Software versions: %s %s, calibre %s, %s" % (self.name, self.version_str,
                  get_version(), platform_info))
         log.info("KFX Output plugin help is available at http://www.mobileread.com/forums/showthread.php?t=272407")
 
     def convert_using_previewer(self, log, book_name, input_filename, asin, cde_type_pdoc, approximate_pages,
                                 include_logs, save_cleaned, enable_timeout, quality_report, output):
-        from calibre_plugins.kfx_output.kfxlib import (file_write_binary, set_logger, YJ_Book)
+        from calibre_plugins.kfx_output.kfxlib import (set_logger, YJ_Book)
 
         set_logger(log)
         log.info("Converting %s" % input_filename)
 
+        kpf_filename = self.temporary_file(".kpf").name
         result = YJ_Book(input_filename, log).convert_to_kpf(
                 timeout_sec=TIMEOUT if enable_timeout else None,
                 flags={"QC"} if quality_report else None,
-                cleaned_filename=os.path.splitext(output)[0] + "_cleaned.epub" if save_cleaned else None)
+                cleaned_filename=os.path.splitext(output)[0] + "_cleaned.epub" if save_cleaned else None,
+                kpf_filename=kpf_filename)
         set_logger()
 
-        if not result.kpf_data:
+        if result.kpf_filename is None:
             log.info("\n****************** Conversion Failure Reason *****************")
             log.info(result.error_msg)
             log.info("**************************************************************")
@@ -301,12 +332,9 @@ class KFXOutput(OutputFormatPlugin):
             print(result.logs)
             log.info("*************************************************************")
 
-        if not result.kpf_data:
+        if result.kpf_filename is None:
             self.report_failure("Conversion error", result.error_msg, book_name)
 
-        kpf_filename = self.temporary_file(".kpf").name
-        file_write_binary(kpf_filename, result.kpf_data)
-
         input_format = os.path.splitext(input_filename)[1][1:].upper()
         log.info("Successfully converted %s to KPF" % input_format)
 
@@ -340,7 +368,7 @@ class KFXOutput(OutputFormatPlugin):
         set_logger()
 
         if log.errors and not self.cli:
-            self.report_failure("KFX creation error", "\n".join(log.errors), book_name)
+            self.report_failure("KFX creation error", "\n".join(log.summary_errors()), book_name)
 
         file_write_binary(output, kfx_data)
         log.info("Successfully converted to KFX")
@@ -349,9 +377,11 @@ class KFXOutput(OutputFormatPlugin):
         if self.cli:
             raise Exception(cat + ": " + msg)
         else:
+            from calibre.ebooks.conversion import ConversionUserFeedBack
             from calibre_plugins.kfx_output.kfxlib import clean_message
-            bn = "<b>Cannot convert " + clean_message(book_name) + "</b><br><br>" if book_name else ""
-            raise ConversionUserFeedBack("KFX conversion failed", bn + "<b>" + cat + ":</b> " + clean_message(msg), level="error")
+            bn = "".join(("<b>Cannot convert ", clean_message(book_name), "</b><br><br>")) if book_name else ""
+            raise ConversionUserFeedBack(
+                    "KFX conversion failed", "".join((bn, "<b>", cat, ":</b> ", clean_message(msg))), level="error")
 
     def init_embedded_plugins(self):
         from calibre.customize.ui import _initialized_plugins
@@ -380,6 +410,7 @@ class JobLog(object):
         self.logger = logger
         self.errors = []
         self.warnings = []
+        self.omitted_errors = 0
 
     def debug(self, msg):
         self.logger.debug(msg)
@@ -388,19 +419,34 @@ class JobLog(object):
         self.logger.info(msg)
 
     def warn(self, msg):
-        self.warnings.append(msg)
+        if len(self.warnings) < MAX_JOB_LOG_MESSAGES:
+            self.warnings.append(msg)
+
         self.logger.warn("WARNING: %s" % msg)
 
     def warning(self, desc):
         self.warn(desc)
 
     def error(self, msg):
-        self.errors.append(msg)
+        self.add_error(msg)
         self.logger.error("ERROR: %s" % msg)
 
     def exception(self, msg):
-        self.errors.append("EXCEPTION: %s" % msg)
+        self.add_error("EXCEPTION: %s" % msg)
         self.logger.exception("EXCEPTION: %s" % msg)
 
+    def add_error(self, msg):
+        # the earliest errors usually identify the root cause, so those are the ones kept
+        if len(self.errors) < MAX_JOB_LOG_MESSAGES:
+            self.errors.append(msg)
+        else:
+            self.omitted_errors += 1
+
+    def summary_errors(self):
+        if not self.omitted_errors:
+            return self.errors
+
+        return self.errors + ["... (%d total)" % (len(self.errors) + self.omitted_errors)]
+
     def __call__(self, *args):
-        self.info(" ".join([str(arg) for arg in args]))
+        self.info(" ".join(str(arg) for arg in args))
@@ -6,10 +6,12 @@ from __future__ import (unicode_literals, division, absolute_import, print_funct
 import base64
 import collections
 import io
+import mmap
 import os
 import platform
 import re
 import shutil
+import stat
 import subprocess
 import time
 
@@ -49,9 +51,15 @@ MAX_GUIDANCE = 100
 
 
 CONVERSION_SLEEP_SEC = 0.1
-COMPLETION_SLEEP_SEC = 1.0
+CONVERSION_POLL_SEC = 1.0       # interval for checking the console while waiting for a process to complete
+COMPLETION_SLEEP_SEC = 1.0      # delay before capturing the alternate console buffer
 UNKNOWN_VERSION_PREFIX = "unknown"
 EXECUTABLE_EXT = ".exe" if IS_WINDOWS or IS_LINUX else ""
+BASE64_ARG_RE = re.compile(r"^[A-Za-z0-9+/=]+$")
+UNSAFE_FILENAME_CHARS_RE = re.compile(r"[^a-zA-Z0-9 :/\\_+-]")
+LEADING_ALPHA_RE = re.compile(r"^[a-zA-Z]")
+WINE_REG_PREVIEWER_KEY_RE = re.compile(br"^\[Software\\\\Amazon\\\\Kindle Previewer 3\]", re.MULTILINE)
+WINE_REG_DEFAULT_VALUE_RE = re.compile(br"@=\"([^\"]*)\"")
 
 
 class ConversionApplication(object):
@@ -65,19 +73,24 @@ class ConversionApplication(object):
         self.program_version_sort = natural_sort_key(self.program_version)
 
         if not self.program_version.startswith(UNKNOWN_VERSION_PREFIX):
-            if self.MIN_SUPPORTED_VERSION and self.program_version_sort < natural_sort_key(self.MIN_SUPPORTED_VERSION):
+            if self.MIN_SUPPORTED_VERSION and self.program_version_sort < self.MIN_SUPPORTED_VERSION_SORT:
                 raise Exception("Unsupported %s version %s is installed (version %s or newer required)" % (
                         self.PROGRAM_NAME, self.program_version, self.MIN_SUPPORTED_VERSION))
 
-            if self.MIN_DESIRED_VERSION and self.program_version_sort < natural_sort_key(self.MIN_DESIRED_VERSION):
+            if self.MIN_DESIRED_VERSION and self.program_version_sort < self.MIN_DESIRED_VERSION_SORT:
                 log.warning("%s version %s is installed. Updating to a more recent version is recommended for better conversion results" % (
                         self.PROGRAM_NAME, self.program_version))
 
     def get_program_version(self):
-        if not os.path.isfile(self.main_program_path):
+        try:
+            program_stat = os.stat(self.main_program_path)
+        except Exception:
+            return UNKNOWN_VERSION_PREFIX
+
+        if not stat.S_ISREG(program_stat.st_mode):
             return UNKNOWN_VERSION_PREFIX
 
-        program_len = os.path.getsize(self.main_program_path)
+        program_len = program_stat.st_size
         return self.PROGRAM_VERSIONS.get(program_len, "%s_%d" % (UNKNOWN_VERSION_PREFIX, program_len))
 
 
@@ -228,6 +241,9 @@ class KindlePreviewer(ConversionApplication):
     if not MIN_DESIRED_VERSION:
         MIN_DESIRED_VERSION = sorted(list(PROGRAM_VERSIONS.values()), key=natural_sort_key)[-1]
 
+    MIN_SUPPORTED_VERSION_SORT = natural_sort_key(MIN_SUPPORTED_VERSION)
+    MIN_DESIRED_VERSION_SORT = natural_sort_key(MIN_DESIRED_VERSION)
+
     def locate_program(self):
         program_path = tweaks.get("kfx_output_previewer_path")
         if program_path:
@@ -260,16 +276,18 @@ class KindlePreviewer(ConversionApplication):
             if not os.path.isfile(userreg):
                 raise Exception("Wine registry file %s not found. Ensure that Wine is correctly installed." % userreg)
 
-            with io.open(userreg, "r") as file:
-                for line in file:
-                    if line.startswith("[Software\\\\Amazon\\\\Kindle Previewer 3]"):
-                        for line in file:
-                            match = re.search("@=\"([^\"]*)\"", line)
+            with io.open(userreg, "rb") as file:
+                if os.fstat(file.fileno()).st_size > 0:
+                    reg = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                    try:
+                        key = WINE_REG_PREVIEWER_KEY_RE.search(reg)
+                        if key:
+                            key_end = reg.find(b"\n[", key.end())
+                            match = WINE_REG_DEFAULT_VALUE_RE.search(reg, key.end(), key_end if key_end >= 0 else len(reg))
                             if match:
-                                return winepath(match.group(1))
-
-                            if line.startswith("["):
-                                break
+                                return winepath(match.group(1).decode("utf-8"))
+                    finally:
+                        reg.close()
 
             raise Exception("Kindle Previewer 3 not found in %s." % userreg)
 
@@ -278,10 +296,10 @@ class ConversionProcess(object):
     PATH_VAR_NAME = "Path" if IS_WINDOWS else "PATH"
     use_wincon = False
 
-    KNOWN_ENVIRONMENT_VARS = [
+    KNOWN_ENVIRONMENT_VARS = frozenset([
         "CLASSPATH", "DYLD_LIBRARY_PATH", "HOME", "JAVA_HOME", "JAVA_TOOL_OPTIONS", "LOGNAME", "OS", PATH_VAR_NAME, "PATHEXT",
         "SHELL", "SystemDrive", "SystemRoot", "TEMP", "TMP", "TMPDIR", "USER", "USERNAME", "USERPROFILE", "WINDIR",
-        ]
+        ])
 
     def __init__(self, sequence, log_output=False):
         self.sequence = sequence
@@ -330,7 +348,7 @@ class ConversionProcess(object):
         start_time = time.time()
         timeout = False
 
-        while self.process.poll() is None:
+        while not self.wait_for_process(self.wait_interval_sec(start_time)):
             if self.wincon is not None:
                 self.wincon.restore_original_console_buffer_on_change()
 
@@ -344,20 +362,16 @@ class ConversionProcess(object):
                         child.kill()
                     psutil.wait_procs(children, timeout=5)
                     parent.kill()
+                    parent.wait(5)
                 else:
                     self.process.kill()
 
-                parent.wait(5)
-
-            time.sleep(CONVERSION_SLEEP_SEC)
-
         duration = time.time() - start_time
         if duration > LOG_CONVERSION_DURATION_SEC:
             log.info("Conversion process took %d seconds" % duration)
 
-        time.sleep(COMPLETION_SLEEP_SEC)
-
         if self.wincon is not None:
+            time.sleep(COMPLETION_SLEEP_SEC)    # allow console output from the process to settle before capturing it
             self.wincon.restore_original_console_buffer()
             self.write_out_file(self.wincon.get_alternate_console_data())
             self.wincon.free_alternate_console_buffer()
@@ -382,6 +396,36 @@ class ConversionProcess(object):
         else:
             self.log_data[os.path.basename(self.out_file_name)] = self.output
 
+    def wait_interval_sec(self, start_time):
+        if self.wincon is not None and self.wincon.watching_for_change():
+            return CONVERSION_POLL_SEC
+
+        if self.timeout_sec:
+            return max(self.timeout_sec - (time.time() - start_time), CONVERSION_SLEEP_SEC)
+
+        return None
+
+    def wait_for_process(self, timeout_sec):
+        # wait up to timeout_sec (or indefinitely if None) and return True if the process has completed
+
+        if IS_PYTHON2:
+            end_time = None if timeout_sec is None else time.time() + timeout_sec
+
+            while self.process.poll() is None:
+                if end_time is not None and time.time() >= end_time:
+                    return False
+
+                time.sleep(CONVERSION_SLEEP_SEC)
+
+            return True
+
+        try:
+            self.process.wait(timeout=timeout_sec)
+        except subprocess.TimeoutExpired:
+            return False
+
+        return True
+
     def close_out_file(self):
         if self.out_file is not None:
             self.out_file.close()
@@ -395,49 +439,50 @@ class ConversionProcess(object):
         self.write_out_file("\n%s\n" % msg)
 
     def get_clean_environment(self):
-        self.env = {}
-        for env_var in self.KNOWN_ENVIRONMENT_VARS:
-            val = os_environ_get(env_var)
-            if val is not None:
-                self.env[env_var] = val
+        if IS_PYTHON2:
+            env = ((env_var, os_environ_get(env_var)) for env_var in self.KNOWN_ENVIRONMENT_VARS)
+            self.env = dict((env_var, val) for env_var, val in env if val is not None)
+        else:
+            environ = os.environ
+            self.env = {env_var: environ[env_var] for env_var in self.KNOWN_ENVIRONMENT_VARS if env_var in environ}
 
     def execution_environment_log(self):
-        exe_env = []
-        exe_env.append("platform: %s, architecture: %s, locale: %s" % (
-                platform.platform(), platform.architecture(), LOCALE_ENCODING))
-        exe_env.append("program_path: %s" % self.application.program_path)
-        exe_env.append("cwd: %s" % self.working_dir)
-
-        exe_env.append("argv:")
-        for arg in self.argv:
-            if re.match(r"^[A-Za-z0-9+/=]+$", arg):
-                try:
-                    arg_decoded = base64.b64decode(arg).decode("ascii")
-                except Exception:
-                    pass
-                else:
-                    arg = "%s (base64) --> %s" % (arg, arg_decoded)
+        exe_env = [
+            get_platform_description(),
+            "program_path: %s" % self.application.program_path,
+            "cwd: %s" % self.working_dir,
+            "argv:",
+            ]
 
-            exe_env.append("  %s" % arg)
+        exe_env.extend("  %s" % self.describe_arg(arg) for arg in self.argv)
 
         if self.env is not None:
             exe_env.append("environment:")
-            for k, v in sorted(self.env.items()):
-                exe_env.append("  %s = %s" % (k, v))
+            exe_env.extend("  %s = %s" % kv for kv in sorted(self.env.items()))
         else:
             exe_env.append("default environment:")
-            for k, v in sorted(os.environ.items()):
-                exe_env.append("  %s = %s" % (k, v))
+            exe_env.extend("  %s = %s" % kv for kv in sorted(os.environ.items()))
 
         return "\n".join(exe_env)
 
+    def describe_arg(self, arg):
+        if len(arg) % 4 == 0 and BASE64_ARG_RE.match(arg):
+            try:
+                arg_decoded = base64.b64decode(arg).decode("ascii")
+            except Exception:
+                pass
+            else:
+                return "%s (base64) --> %s" % (arg, arg_decoded)
+
+        return arg
+
 
 class ConversionSequence(object):
 
     def __init__(self):
         pass
 
-    def convert(self, infile, flags, timeout_sec, cleaned_filename):
+    def convert(self, infile, flags, timeout_sec, cleaned_filename, kpf_filename=None):
         self.infile = infile
         self.flags = flags
         self.timeout_sec = timeout_sec
@@ -462,14 +507,24 @@ class ConversionSequence(object):
             return ConversionResult(error_msg="Conversion disabled")
 
         result = self.perform_conversion_sequence()
+
+        if result.kpf_filename is not None:
+            # move the KPF out of the temporary directory before it is removed
+            if kpf_filename:
+                shutil.move(result.kpf_filename, kpf_filename)
+                result.kpf_filename = kpf_filename
+            else:
+                result.kpf_data = file_read_binary(result.kpf_filename)
+                result.kpf_filename = None
+
         self.cleanup_temp_files()
         return result
 
     def prepare_epub(self):
         root, ext = os.path.splitext(os.path.basename(self.infile))
-        simple_in_file_name = re.sub(r"[^a-zA-Z0-9 :/\\_+-]", "", root)
+        simple_in_file_name = UNSAFE_FILENAME_CHARS_RE.sub("", root)
 
-        if not re.match(r"^[a-zA-Z]", simple_in_file_name):
+        if not LEADING_ALPHA_RE.match(simple_in_file_name):
             simple_in_file_name = "f" + simple_in_file_name
 
         self.in_file_name = os.path.join(self.data_dir, simple_in_file_name + ext)
@@ -504,15 +559,23 @@ class ConversionSequence(object):
 
 
 class ConversionResult(object):
-    def __init__(self, kpf_data=None, error_msg="", log_data={}, guidance_msgs=[], cleaned_epub_data=None):
+    def __init__(self, kpf_data=None, error_msg="", log_data={}, guidance_msgs=[], cleaned_epub_data=None, kpf_filename=None,
+                 omitted_guidance=0):
         self.kpf_data = kpf_data
+        self.kpf_filename = kpf_filename
         self.error_msg = error_msg
         self.logs = self.combine_logs(log_data, error_msg)
 
-        if kpf_data is not None and error_msg:
+        if (kpf_data is not None or kpf_filename is not None) and error_msg:
             guidance_msgs = guidance_msgs + [error_msg]
 
-        self.guidance = "\n".join(truncate_list(guidance_msgs, MAX_GUIDANCE))
+        if omitted_guidance:
+            # messages past the limit were counted but not collected
+            guidance_msgs = guidance_msgs[:MAX_GUIDANCE] + ["... (%d total)" % (len(guidance_msgs) + omitted_guidance)]
+        else:
+            guidance_msgs = truncate_list(guidance_msgs, MAX_GUIDANCE)
+
+        self.guidance = "\n".join(guidance_msgs)
         self.cleaned_epub_data = cleaned_epub_data
 
     def combine_logs(self, log_data, error_msg):
@@ -527,3 +590,17 @@ class ConversionResult(object):
             log_lst.append("")
 
         return "\n".join(log_lst)
+
+
+platform_description_ = None
+
+
+def get_platform_description():
+    global platform_description_
+
+    if platform_description_ is None:
+        # platform.architecture may run the "file" command, so only do this once per process
+        platform_description_ = "platform: %s, architecture: %s, locale: %s" % (
+                platform.platform(), platform.architecture(), LOCALE_ENCODING)
+
+    return platform_description_
@@ -5,13 +5,16 @@ from __future__ import (unicode_literals, division, absolute_import, print_funct
 
 import csv
 import io
+import itertools
 import os
 import re
+import shutil
+import sys
 
-from .generate_kpf_common import (ConversionProcess, ConversionResult, ConversionSequence, KindlePreviewer)
+from .generate_kpf_common import (ConversionProcess, ConversionResult, ConversionSequence, KindlePreviewer, MAX_GUIDANCE)
 from .message_logging import log
 from .utilities import (
-    file_read_binary, file_read_utf8, join_search_path, natural_sort_key, winepath,
+    join_search_path, natural_sort_key, windows_long_path_fix, winepath,
     IS_LINUX, PATH_SEPARATOR)
 
 from .python_transition import IS_PYTHON2
@@ -24,6 +27,17 @@ __copyright__ = "2021, John Howell <jhowell@acm.org>"
 
 
 MAX_CONVERSION_RETRIES = 5
+MIN_CLI_VERSION_SORT = natural_sort_key("3.32.0")
+MIN_QUALITY_CHECKS_VERSION_SORT = natural_sort_key("3.40.0")
+
+LOG_MESSAGE_FIELDS = frozenset(["Type", "Description"])
+LOG_MESSAGE_SOURCE_FIELDS = LOG_MESSAGE_FIELDS | frozenset(["Source File", "Line Number"])
+QUALITY_REPORT_MESSAGE_FIELDS = frozenset(["Type", "Category", "Description"])
+
+INTERNAL_FILENAME_PATTERN = r".*cTemp[/\\]mTemp[/\\]mbp_[0-9A-F_]*[/\\]"
+INTERNAL_FILENAME_RES = {}      # prefix --> compiled pattern
+
+MISSING_CSV_COLUMN = sys.maxsize
 
 
 class KPR_CLI(ConversionSequence):
@@ -37,8 +51,9 @@ class KPR_CLI(ConversionSequence):
         retry_count = 0
         result, allow_retry = self.perform_conversion_sequence_once()
 
-        while result.kpf_data is None and retry_count < MAX_CONVERSION_RETRIES and allow_retry:
+        while result.kpf_filename is None and retry_count < MAX_CONVERSION_RETRIES and allow_retry:
             log.info("Unknown conversion error occurred -- Retrying")
+            shutil.rmtree(self.out_dir, ignore_errors=True)
             retry_count += 1
             result, allow_retry = self.perform_conversion_sequence_once()
 
@@ -53,24 +68,23 @@ class KPR_CLI(ConversionSequence):
         allow_retry = not cli.process_failure
         log_data = cli.log_data
         guidance_msgs = []
-        kpf_data = None
+        omitted_guidance = 0
+        kpf_filename = None
 
         summary_log_name = "Summary_Log.csv"
         summary_log_csv_file = os.path.join(self.out_dir, summary_log_name)
         conversion_log_file = quality_report_file = None
 
         if os.path.isfile(summary_log_csv_file):
-            log_data[summary_log_name] = lg = file_read_utf8(summary_log_csv_file, "utf-8-sig")
-
             try:
-                with io.BytesIO(lg.encode("utf-8")) if IS_PYTHON2 else io.StringIO(lg) as csvfile:
-                    for row in csv.DictReader(csvfile):
+                with CSVLogFile(summary_log_csv_file, log_data) as csv_log:
+                    for row in csv_log.rows():
                         if ustr(row["Conversion Status"]) == "Success":
                             output_filename = self.fix_output_filename(ustr(row["Output File Path"]))
 
                             if ustr(row["Enhanced Typesetting Status"]) == "Supported":
                                 if os.path.isfile(output_filename):
-                                    kpf_data = file_read_binary(output_filename)
+                                    kpf_filename = output_filename
                                 else:
                                     error_msg = "KPF file is missing: \"%s\"" % output_filename
                                     break
@@ -87,7 +101,7 @@ class KPR_CLI(ConversionSequence):
                         quality_report_file = ustr(row.get("Quality Report Path"))
                         break
                     else:
-                        error_msg = "Failed to locate results in %s: %s" % (summary_log_name, lg)
+                        error_msg = "Failed to locate results in %s: %s" % (summary_log_name, csv_log.text())
                         allow_retry = False
             except Exception as e:
                 error_msg = "Exception occurred processing %s: %s" % (summary_log_name, repr(e))
@@ -99,17 +113,17 @@ class KPR_CLI(ConversionSequence):
         if conversion_log_file:
             if os.path.isfile(conversion_log_file):
                 try:
-                    log_data[os.path.basename(conversion_log_file)] = lg = file_read_utf8(conversion_log_file, "utf-8-sig")
-
-                    while "\n" in lg and not lg.startswith("\"Type\""):
-                        lg = lg.partition("\n")[2]
-
-                    have_error_msg = False
-                    with io.BytesIO(lg.encode("utf-8")) if IS_PYTHON2 else io.StringIO(lg) as logfile:
-                        for row in csv.DictReader(logfile):
-                            field = dict(row)
-                            msg_type = ustr(field.pop("Type", ""))
-                            description = self.simplify_internal_filename(ustr(field.pop("Description", "")).strip(), " in file: ")
+                    with CSVLogFile(conversion_log_file, log_data, "\"Type\"") as csv_log:
+                        columns, rows = csv_log.column_rows()
+                        type_col, description_col, source_file_col, line_number_col = csv_column_indexes(
+                                columns, "Type", "Description", "Source File", "Line Number")
+                        other_columns = csv_other_columns(columns, LOG_MESSAGE_FIELDS)
+                        other_source_columns = csv_other_columns(columns, LOG_MESSAGE_SOURCE_FIELDS)
+
+                        have_error_msg = False
+                        for row in rows:
+                            msg_type = csv_value(row, type_col)
+                            description = self.simplify_internal_filename(csv_value(row, description_col).strip(), " in file: ")
                             msg = "%s %s" % (msg_type, description)
 
                             if msg_type in {"Error", "ET Error"} and not have_error_msg:
@@ -117,21 +131,26 @@ class KPR_CLI(ConversionSequence):
                                 have_error_msg = True
                                 allow_retry = False
 
+                            if len(guidance_msgs) >= MAX_GUIDANCE:
+                                omitted_guidance += 1
+                                continue
+
                             guidance_lines = [msg]
 
-                            source_file = ustr(field.pop("Source File", ""))
+                            source_file = csv_value(row, source_file_col)
                             if source_file:
                                 msg = "    Source File: %s" % self.simplify_internal_filename(source_file)
 
-                                line_number = ustr(field.pop("Line Number", ""))
+                                line_number = csv_value(row, line_number_col)
                                 if line_number:
                                     msg += " (Line %s)" % line_number
 
                                 guidance_lines.append(msg)
 
-                            for k, v in sorted(field.items()):
-                                if k is not None and v:
-                                    guidance_lines.append("    %s: %s" % (ustr(k), ustr(v)))
+                            for index, name in (other_source_columns if source_file else other_columns):
+                                value = csv_value(row, index)
+                                if value:
+                                    guidance_lines.append("    %s: %s" % (name, value))
 
                             guidance_msgs.append("\n".join(guidance_lines) + "\n")
 
@@ -147,25 +166,28 @@ class KPR_CLI(ConversionSequence):
 
             if os.path.isfile(quality_report_file):
                 try:
-                    log_data[os.path.basename(quality_report_file)] = lg = file_read_utf8(quality_report_file, "utf-8-sig")
-
-                    while "\n" in lg and not lg.startswith("\"Type\""):
-                        lg = lg.partition("\n")[2]
-
-                    with io.BytesIO(lg.encode("utf-8")) if IS_PYTHON2 else io.StringIO(lg) as reportfile:
-                        for row in csv.DictReader(reportfile):
-                            field = dict(row)
-                            msg_type = ustr(field.pop("Type", ""))
-                            category = ustr(field.pop("Category", "")).strip()
-                            description = ustr(field.pop("Description", "")).strip()
+                    with CSVLogFile(quality_report_file, log_data, "\"Type\"") as csv_log:
+                        columns, rows = csv_log.column_rows()
+                        type_col, category_col, description_col = csv_column_indexes(columns, "Type", "Category", "Description")
+                        other_columns = csv_other_columns(columns, QUALITY_REPORT_MESSAGE_FIELDS)
+
+                        for row in rows:
+                            if len(guidance_msgs) >= MAX_GUIDANCE:
+                                omitted_guidance += 1
+                                continue
+
+                            msg_type = csv_value(row, type_col)
+                            category = csv_value(row, category_col).strip()
+                            description = csv_value(row, description_col).strip()
                             msg = (
                                 ("%s Quality (%s): %s" % (msg_type, category, description)) if category else
                                 ("%s Quality: %s" % (msg_type, description)))
                             guidance_lines = [msg]
 
-                            for k, v in sorted(field.items()):
-                                if k is not None and v:
-                                    guidance_lines.append("    %s: %s" % (ustr(k), ustr(v)))
+                            for index, name in other_columns:
+                                value = csv_value(row, index)
+                                if value:
+                                    guidance_lines.append("    %s: %s" % (name, value))
 
                             guidance_msgs.append("%s\n" % ("\n".join(guidance_lines)))
 
@@ -174,7 +196,9 @@ class KPR_CLI(ConversionSequence):
             else:
                 guidance_msgs.append("Quality report file is missing: %s\n" % quality_report_file)
 
-        return ConversionResult(kpf_data=kpf_data, error_msg=error_msg, log_data=log_data, guidance_msgs=guidance_msgs), allow_retry
+        return ConversionResult(
+                kpf_filename=kpf_filename, error_msg=error_msg, log_data=log_data, guidance_msgs=guidance_msgs,
+                omitted_guidance=omitted_guidance), allow_retry
 
     def fix_output_filename(self, filename):
 
@@ -192,7 +216,16 @@ class KPR_CLI(ConversionSequence):
         return filename
 
     def simplify_internal_filename(self, msg, prefix=""):
-        return re.sub((prefix or "^") + ".*cTemp[/\\\\]mTemp[/\\\\]mbp_[0-9A-F_]*[/\\\\]", prefix, msg, count=1)
+        internal_filename_re = INTERNAL_FILENAME_RES.get(prefix)
+        if internal_filename_re is None:
+            internal_filename_re = INTERNAL_FILENAME_RES[prefix] = re.compile(
+                    (re.escape(prefix) if prefix else "^") + INTERNAL_FILENAME_PATTERN)
+
+        match = internal_filename_re.search(msg)
+        if match is None:
+            return msg
+
+        return msg[:match.start()] + prefix + msg[match.end():]
 
 
 class KPR_CLI_Process(ConversionProcess):
@@ -200,7 +233,7 @@ class KPR_CLI_Process(ConversionProcess):
     use_wincon = True
 
     def run(self, in_file_name, out_dir):
-        if self.application.program_version_sort < natural_sort_key("3.32.0"):
+        if self.application.program_version_sort < MIN_CLI_VERSION_SORT:
             raise Exception("CLI not available in Kindle Previewer version %s" % self.program_version)
 
         self.argv = [
@@ -211,7 +244,7 @@ class KPR_CLI_Process(ConversionProcess):
             "-output", out_dir,
             ]
 
-        if "QC" in self.sequence.flags and self.application.program_version_sort >= natural_sort_key("3.40.0"):
+        if "QC" in self.sequence.flags and self.application.program_version_sort >= MIN_QUALITY_CHECKS_VERSION_SORT:
             self.argv.append("-qualitychecks")
 
         self.working_dir = out_dir
@@ -237,5 +270,74 @@ class KPR_CLI_Process(ConversionProcess):
         ConversionProcess.run(self)
 
 
-def ustr(s):
-    return s.decode("utf-8") if isinstance(s, bytes) else s
+if IS_PYTHON2:
+    def ustr(s):
+        return s.decode("utf-8") if isinstance(s, bytes) else s
+
+    def csv_value(row, index):
+        return ustr(row[index]) if index < len(row) else ""
+else:
+    def ustr(s):
+        # csv produces str when reading text under Python 3
+        return s
+
+    def csv_value(row, index):
+        return row[index] if index < len(row) else ""
+
+
+def csv_column_indexes(columns, *names):
+    return [columns.index(name) if name in columns else MISSING_CSV_COLUMN for name in names]
+
+
+def csv_other_columns(columns, excluded_names):
+    return [(index, name) for index, name in enumerate(columns) if name not in excluded_names]
+
+
+class CSVLogFile(object):
+    # CSV file created by the Kindle Previewer, parsed while it is read and retained in log_data once closed
+
+    def __init__(self, filename, log_data, header_prefix=None):
+        self.filename = filename
+        self.log_data = log_data
+        self.header_prefix = header_prefix
+
+    def __enter__(self):
+        self.file = io.open(windows_long_path_fix(self.filename), "r", encoding="utf-8-sig", errors="replace", newline="")
+        self.lines = []
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        try:
+            self.log_data[os.path.basename(self.filename)] = self.text()
+        finally:
+            self.file.close()
+
+    def rows(self):
+        return csv.DictReader(self.csv_lines())
+
+    def column_rows(self):
+        # returns the column names and an iterator over the non-empty data rows as lists of values
+        reader = csv.reader(self.csv_lines())
+        columns = [ustr(column) for column in next(reader, [])]
+        return columns, (row for row in reader if row)
+
+    def csv_lines(self):
+        lines = self.read_lines()
+
+        if self.header_prefix:
+            lines = itertools.dropwhile(lambda line: not line.startswith(self.header_prefix), lines)
+
+        if IS_PYTHON2:
+            lines = (line.encode("utf-8") for line in lines)
+
+        return lines
+
+    def read_lines(self):
+        for line in self.file:
+            line = line.replace("\r", "")
+            self.lines.append(line)
+            yield line
+
+    def text(self):
+        self.lines.extend(line.replace("\r", "") for line in self.file)
+        return "".join(self.lines)
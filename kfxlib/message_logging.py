@@ -13,22 +13,23 @@ thread_local_cfg = threading.local()
 def set_logger(logger=None):
     global thread_local_cfg
 
-    if log is not None:
+    if logger is not None:
         thread_local_cfg.logger = logger
     else:
-        del thread_local_cfg.logger
+        thread_local_cfg.__dict__.pop("logger", None)
 
     return logger
 
 
 def get_current_logger():
-    return getattr(thread_local_cfg, "logger", logging)
+    return thread_local_cfg.__dict__.get("logger", logging)
 
 
 class LogCurrent(object):
 
     def __getattr__(self, method_name):
-        return getattr(get_current_logger(), method_name)
+        # look up the logger of the current thread directly to keep the overhead of each logging call low
+        return getattr(thread_local_cfg.__dict__.get("logger", logging), method_name)
 
 
 log = LogCurrent()
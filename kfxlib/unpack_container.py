@@ -1,9 +1,15 @@
 from __future__ import (unicode_literals, division, absolute_import, print_function)
 
 import io
+import multiprocessing
 import posixpath
 import zipfile
 
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None
+
 from .ion import (IonAnnotation, IonBLOB)
 from .ion_text import IonText
 from .message_logging import log
@@ -16,6 +22,10 @@ __license__ = "GPL v3"
 __copyright__ = "2021, John Howell <jhowell@acm.org>"
 
 
+MAX_READ_THREADS = 8
+MIN_RESOURCES_PER_READ_THREAD = 16
+
+
 class IonTextContainer(YJContainer):
     def deserialize(self, ignore_drm=False):
         self.fragments.clear()
@@ -34,28 +44,64 @@ class ZipUnpackContainer(YJContainer):
 
     def deserialize(self, ignore_drm=False):
         with self.datafile.as_ZipFile() as zf:
+            book_info = None
+            resource_infos = []
             for info in zf.infolist():
                 if info.filename == "book.ion":
-                    IonTextContainer(self.symtab, datafile=DataFile(info.filename, data=zf.read(info)),
-                                     fragments=self.fragments).deserialize()
-                    break
-            else:
+                    if book_info is None:
+                        book_info = info
+                elif not info.filename.endswith("/"):
+                    resource_infos.append(info)
+
+            if book_info is None:
                 raise Exception("book.ion file missing from ZipUnpackContainer")
 
-            fonts = set()
-            for fragment in self.fragments:
-                if fragment.ftype == "$262":
-                    fonts.add(fragment.value.get("$165"))
+            IonTextContainer(self.symtab, datafile=DataFile(book_info.filename, data=zf.read(book_info)),
+                             fragments=self.fragments).deserialize()
 
-            for info in zf.infolist():
-                if info.filename != "book.ion" and not info.filename.endswith("/"):
-                    fn, ext = posixpath.splitext(info.filename)
+            fonts = frozenset(fragment.value.get("$165") for fragment in self.fragments if fragment.ftype == "$262")
+            font_ftype, image_ftype = "$418", "$417"
+            append = self.fragments.append
+
+            for info, data in zip(resource_infos, self.read_resources(zf, resource_infos)):
+                filename = info.filename
+                basename_start = filename.rfind("/") + 1
+                dot = filename.rfind(".")
+
+                # split off the extension the same way as posixpath.splitext, but without its overhead
+                if dot > basename_start and filename[basename_start:dot].strip("."):
+                    fn = filename[:dot]
+                    fid = fn[:-1] if fn.endswith(self.ADDED_EXT_FLAG_CHAR) else filename
+                else:
+                    fid = filename
+
+                append(YJFragment(
+                        ftype=(font_ftype if fid in fonts else image_ftype), fid=fid,
+                        value=IonBLOB(data)))
+
+    def read_resources(self, zf, infos):
+        # decompression releases the GIL, so large numbers of resources are read in parallel with one ZipFile per thread
+        num_threads = 1
+        if ThreadPoolExecutor is not None:
+            try:
+                cpu_count = multiprocessing.cpu_count()     # also available under Python 2, unlike os.cpu_count
+            except Exception:
+                cpu_count = 1
+
+            num_threads = min(MAX_READ_THREADS, cpu_count, len(infos) // MIN_RESOURCES_PER_READ_THREAD)
+
+        if num_threads < 2:
+            return [zf.read(info) for info in infos]
+
+        batch_size = (len(infos) + num_threads - 1) // num_threads
+        batches = [infos[i:i + batch_size] for i in range(0, len(infos), batch_size)]
 
-                    fid = fn[:-1] if ext and fn.endswith(self.ADDED_EXT_FLAG_CHAR) else info.filename
+        def read_batch(batch):
+            with self.datafile.as_ZipFile() as batch_zf:
+                return [batch_zf.read(info) for info in batch]
 
-                    self.fragments.append(YJFragment(
-                            ftype=("$418" if fid in fonts else "$417"), fid=fid,
-                            value=IonBLOB(zf.read(info))))
+        with ThreadPoolExecutor(max_workers=len(batches)) as executor:
+            return [data for batch_data in executor.map(read_batch, batches) for data in batch_data]
 
     def serialize(self):
         desired_extension = {}
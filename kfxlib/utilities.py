@@ -12,10 +12,8 @@ import locale
 import logging
 import posixpath
 import os
-import random
 import re
 import shutil
-import string
 import struct
 import sys
 import time
@@ -38,6 +36,7 @@ __copyright__ = "2021, John Howell <jhowell@acm.org>"
 
 
 MAX_TEMPDIR_REMOVAL_TRIES = 60
+MAX_NATURAL_SORT_KEYS = 65536
 
 PLATFORM_NAME = sys.platform.lower()
 IS_MACOS = "darwin" in PLATFORM_NAME
@@ -51,6 +50,10 @@ UUID_RE = r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}"
 UUID_MATCH_RE = r"^%s$" % UUID_RE
 
 ZIP_SIGNATURE = b"\x50\x4B\x03\x04"
+ZIP_EXTS = frozenset([".azk", ".kfx-zip", ".kpf", ".zip"])
+
+NATURAL_SORT_SPLIT_RE = re.compile(r"([0-9]+)")
+WINDOWS_DRIVE_PATH_RE = re.compile(r"^[A-Z]:[/\\]", flags=re.IGNORECASE)
 
 
 MIMETYPE_OF_EXT = {
@@ -210,6 +213,14 @@ EXTS_OF_MIMETYPE = {
     "video/webm": [".webm"],
     }
 
+FONT_EXT_OF_SIGNATURE = {
+    b"\x00\x01\x00\x00": ".ttf",
+    b"true": ".ttf",
+    b"typ1": ".ttf",
+    b"OTTO": ".otf",
+    b"wOFF": ".woff",
+    }
+
 
 try:
     from calibre.constants import numeric_version as calibre_numeric_version
@@ -219,7 +230,6 @@ except ImportError:
 
 tempdir_ = None
 atexit_set_ = False
-ALPHA_NUMERIC = string.ascii_lowercase + string.digits
 
 
 try:
@@ -274,7 +284,7 @@ def temp_filename(ext, data=None):
     if ext:
         ext = "." + ext
 
-    unique = "".join(random.choice(ALPHA_NUMERIC) for _ in range(20))
+    unique = bytes_to_hex(os.urandom(10))
     filename = os.path.join(tempdir(), unique + ext)
 
     if data is not None:
@@ -293,8 +303,20 @@ def type_name(x):
     return type(x).__name__
 
 
+natural_sort_keys_ = {}
+
+
 def natural_sort_key(s):
-    return "".join(["00000000"[len(c):] + c if c.isdigit() else c for c in re.split(r"([0-9]+)", s.lower())])
+    # keys are cached since fragment comparisons recompute them for each comparison made while sorting
+    key = natural_sort_keys_.get(s)
+    if key is None:
+        if len(natural_sort_keys_) >= MAX_NATURAL_SORT_KEYS:
+            natural_sort_keys_.clear()
+
+        key = natural_sort_keys_[s] = "".join([
+            "00000000"[len(c):] + c if c.isdigit() else c for c in NATURAL_SORT_SPLIT_RE.split(s.lower())])
+
+    return key
 
 
 def list_keys(a_dict):
@@ -322,7 +344,8 @@ def remove_duplicates(lst):
 
 
 def bytes_to_separated_hex(data, sep=" "):
-    return sep.join("%02x" % b for b in bytes_to_list(data))
+    hex_digits = bytes_to_hex(data)
+    return sep.join(hex_digits[i:i + 2] for i in range(0, len(hex_digits), 2))
 
 
 def quote_name(s):
@@ -405,7 +428,7 @@ def file_write_binary(filename, data):
 def windows_long_path_fix(filename):
 
     if (IS_WINDOWS and len(filename) >= 260 and isinstance(filename, str) and
-            re.match("^[A-Z]:[/\\\\]", filename, flags=re.IGNORECASE) and not os.path.isfile(filename)):
+            WINDOWS_DRIVE_PATH_RE.match(filename) and not os.path.isfile(filename)):
         el_filename = "\\\\?\\" + filename.replace("/", "\\")
         if os.path.isfile(el_filename):
             return el_filename
@@ -422,14 +445,9 @@ class disable_debug_log:
 
 
 def font_file_ext(data, default=""):
-    if data[0:4] in {b"\x00\x01\x00\x00", b"true", b"typ1"}:
-        return ".ttf"
-
-    if data[0:4] == b"OTTO":
-        return ".otf"
-
-    if data[0:4] == b"wOFF":
-        return ".woff"
+    ext = FONT_EXT_OF_SIGNATURE.get(data[0:4])
+    if ext is not None:
+        return ext
 
     if data[34:36] == b"\x4c\x50" and data[8:12] in {b"\x00\x00\x01\x00", b"\x01\x00\x02\x00", b"\x02\x00\x02\x00"}:
         return ".eot"
@@ -738,14 +756,9 @@ def join_search_path(*args):
     pl = []
     for arg in args:
         if arg:
-            pl.extend(arg.split(PATH_SEPARATOR))
-
-    path_list = []
-    for dir in pl:
-        if dir and dir not in path_list:
-            path_list.append(dir)
+            pl.extend(dir for dir in arg.split(PATH_SEPARATOR) if dir)
 
-    return PATH_SEPARATOR.join(path_list)
+    return PATH_SEPARATOR.join(remove_duplicates(pl))
 
 
 def make_unique_name(root_name, check_set, sep="", always_suffix=False):
@@ -797,8 +810,26 @@ class DataFile(object):
 
         return self.data
 
+    def peek_data(self, size):
+        # returns the leading bytes of the data without reading all of a file or stream not yet read
+        if self.data is not None:
+            return self.data[:size]
+
+        if self.stream is not None:
+            self.stream.seek(0)
+            data = self.stream.read(size)
+            self.stream.seek(0)
+            return data
+
+        filename = windows_long_path_fix(self.name)
+        if not os.path.isfile(filename):
+            raise Exception("File %s does not exist." % quote_name(filename))
+
+        with io.open(filename, "rb") as of:
+            return of.read(size)
+
     def is_zipfile(self):
-        return self.ext in [".azk", ".kfx-zip", ".kpf", ".zip"] or self.get_data().startswith(ZIP_SIGNATURE)
+        return self.ext.lower() in ZIP_EXTS or self.peek_data(len(ZIP_SIGNATURE)) == ZIP_SIGNATURE
 
     def as_ZipFile(self):
         if self.is_real_file:
@@ -887,21 +918,18 @@ def convert_pdf_to_jpeg(pdf_data, page_num, dpi=150, reported_errors=None):
         from calibre.ebooks.metadata.pdf import page_images
         page_images(pdf_file, jpeg_dir, first=page_num, last=page_num)
 
-    for dirpath, dirnames, filenames in os.walk(jpeg_dir):
-        if len(filenames) != 1:
-            raise Exception("pdftoppm created %d files" % len(filenames))
+    filenames = os.listdir(jpeg_dir)
+    if not filenames:
+        raise Exception("pdftoppm created no files")
 
-        if not (filenames[0].endswith(".jpg") or filenames[0].endswith(".jpeg")):
-            raise Exception("pdftoppm created unexpected file: %s" % filenames[0])
+    if len(filenames) != 1:
+        raise Exception("pdftoppm created %d files" % len(filenames))
 
-        with io.open(os.path.join(dirpath, filenames[0]), "rb") as of:
-            jpeg_data = of.read()
+    if not filenames[0].endswith((".jpg", ".jpeg")):
+        raise Exception("pdftoppm created unexpected file: %s" % filenames[0])
 
-        break
-    else:
-        raise Exception("pdftoppm created no files")
-
-    return jpeg_data
+    with io.open(os.path.join(jpeg_dir, filenames[0]), "rb") as of:
+        return of.read()
 
 
 def OD(*args):
@@ -1013,42 +1041,44 @@ else:
         return s[start:stop]
 
 
+struct_cache_ = {}
+
+
+def compiled_struct(fmt):
+    s = struct_cache_.get(fmt)
+    if s is None:
+        s = struct_cache_[fmt] = struct.Struct(fmt)
+
+    return s
+
+
 class Serializer(object):
     def __init__(self):
-        self.buffers = []
-        self.length = 0
+        self.buffer = bytearray()
 
     def pack(self, fmt, *values):
-        fmt_pos = (fmt, len(self.buffers))
-        self.append(struct.pack(fmt, *values))
+        fmt_pos = (fmt, len(self.buffer))
+        self.append(compiled_struct(fmt).pack(*values))
         return fmt_pos
 
     def repack(self, fmt_pos, *values):
-        fmt, position = fmt_pos
-        self.buffers[position] = struct.pack(fmt, *values)
+        fmt, offset = fmt_pos
+        compiled_struct(fmt).pack_into(self.buffer, offset, *values)
 
     def append(self, buf):
-        if buf:
-            self.buffers.append(buf)
-            self.length += len(buf)
+        self.buffer.extend(buf)
 
     def extend(self, serializer):
-        self.buffers.extend(serializer.buffers)
-        self.length += serializer.length
+        self.buffer.extend(serializer.buffer)
 
     def __len__(self):
-        return self.length
+        return len(self.buffer)
 
     def serialize(self):
-        return b"".join(self.buffers)
+        return bytes(self.buffer)
 
     def sha1(self):
-        sha1 = hashlib.sha1()
-
-        for buf in self.buffers:
-            sha1.update(buf)
-
-        return sha1.digest()
+        return hashlib.sha1(self.buffer).digest()
 
 
 class Deserializer(object):
@@ -1057,10 +1087,11 @@ class Deserializer(object):
         self.offset = 0
 
     def unpack(self, fmt, advance=True):
-        result = struct.unpack_from(fmt, self.buffer, self.offset)[0]
+        s = compiled_struct(fmt)
+        result = s.unpack_from(self.buffer, self.offset)[0]
 
         if advance:
-            self.offset += struct.calcsize(fmt)
+            self.offset += s.size
 
         return result
 
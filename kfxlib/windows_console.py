@@ -11,12 +11,15 @@ __copyright__ = "2021, John Howell <jhowell@acm.org>"
 MIN_COLS = 200
 MIN_ROWS = 100
 LINE_UNWRAP_CHARS = 10
+MAX_READ_CONSOLE_CELLS = 64 * MIN_COLS      # keeps each ReadConsoleOutput request well below the 64KB console buffer limit
 
 SW_HIDE = 0
 SW_SHOW = 5
 
 CONOUT_FILENAME = "CONOUT$"
 
+CONTROL_CHAR_REMOVAL = dict.fromkeys(range(0x20))
+
 
 class WindowsConsole(object):
     def __init__(self):
@@ -81,10 +84,13 @@ class WindowsConsole(object):
 
             self.current_console_output_handle = self.original_console_output_handle
 
-    def restore_original_console_buffer_on_change(self):
-        if (
+    def watching_for_change(self):
+        return (
                 self.alternate_console_output_handle is not None and self.csbi is not None and
-                self.current_console_output_handle == self.alternate_console_output_handle):
+                self.current_console_output_handle == self.alternate_console_output_handle)
+
+    def restore_original_console_buffer_on_change(self):
+        if self.watching_for_change():
             last_csbi = self.csbi
 
             self.csbi = GetConsoleScreenBufferInfo(self.alternate_console_output_handle)
@@ -110,25 +116,19 @@ class WindowsConsole(object):
             log.warning("ReadConsoleOutput failed %d" % GetLastError())
             return ""
 
-        lines = []
-        for row in range(num_rows):
-            line = ""
-            for col in range(num_columns):
-                ch = console_buffer_data[row][col].UnicodeChar
-                if ord(ch) >= 0x20:
-                    line += ch
+        # view each CHAR_INFO as a pair of WCHAR so that every UnicodeChar is extracted with a single slice
+        num_cells = num_columns * num_rows
+        chars = (WCHAR * (num_cells * 2)).from_buffer(console_buffer_data)[0::2]
 
-            line = line.rstrip()
+        screen = []
+        for start in range(0, num_cells, num_columns):
+            line = chars[start:start + num_columns].translate(CONTROL_CHAR_REMOVAL).rstrip()
             if line:
-                lines.append(line)
-
-        screen = ""
-        for line in lines:
-            screen += line
-            if len(line) < num_columns - LINE_UNWRAP_CHARS:
-                screen += "\n"
+                screen.append(line)
+                if len(line) < num_columns - LINE_UNWRAP_CHARS:
+                    screen.append("\n")
 
-        return screen
+        return "".join(screen)
 
     def free_alternate_console_buffer(self):
         self.restore_original_console_buffer()
@@ -182,21 +182,25 @@ DWORD = ctypes.c_uint32
 TCHAR = ctypes.c_char
 WCHAR = ctypes.c_wchar
 
+# private library instances, so that the function prototypes set here do not affect other users of ctypes.windll
+kernel32 = ctypes.WinDLL("kernel32")
+user32 = ctypes.WinDLL("user32")
 
-def CreateFile(lpFileName, dwDesiredAccess=GENERIC_READ | GENERIC_WRITE, dwShareMode=0, lpSecurityAttributes=NULL,
-               dwCreationDisposition=OPEN_EXISTING, dwFlagsAndAttributes=FILE_ATTRIBUTE_NORMAL, hTemplateFile=NULL):
 
-    CreateFile_Fn = ctypes.windll.kernel32.CreateFileW
-    CreateFile_Fn.argtypes = [
-            ctypes.wintypes.LPWSTR,
-            ctypes.wintypes.DWORD,
-            ctypes.wintypes.DWORD,
-            LPSECURITY_ATTRIBUTES,
-            ctypes.wintypes.DWORD,
-            ctypes.wintypes.DWORD,
-            ctypes.wintypes.HANDLE]
-    CreateFile_Fn.restype = ctypes.wintypes.HANDLE
+CreateFile_Fn = kernel32.CreateFileW
+CreateFile_Fn.argtypes = [
+        ctypes.wintypes.LPWSTR,
+        ctypes.wintypes.DWORD,
+        ctypes.wintypes.DWORD,
+        LPSECURITY_ATTRIBUTES,
+        ctypes.wintypes.DWORD,
+        ctypes.wintypes.DWORD,
+        ctypes.wintypes.HANDLE]
+CreateFile_Fn.restype = ctypes.wintypes.HANDLE
+
 
+def CreateFile(lpFileName, dwDesiredAccess=GENERIC_READ | GENERIC_WRITE, dwShareMode=0, lpSecurityAttributes=NULL,
+               dwCreationDisposition=OPEN_EXISTING, dwFlagsAndAttributes=FILE_ATTRIBUTE_NORMAL, hTemplateFile=NULL):
     return ctypes.wintypes.HANDLE(CreateFile_Fn(
             lpFileName,
             dwDesiredAccess,
@@ -269,43 +273,47 @@ class CONSOLE_SCREEN_BUFFER_INFO(ctypes.Structure):
             repr(self.dwSize), repr(self.dwCursorPosition), self.wAttributes, repr(self.srWindow), repr(self.dwMaximumWindowSize))
 
 
-def SetConsoleActiveScreenBuffer(hConsoleOutput):
-    SetConsoleActiveScreenBuffer_Fn = ctypes.windll.kernel32.SetConsoleActiveScreenBuffer
-    SetConsoleActiveScreenBuffer_Fn.argtypes = [
-            ctypes.wintypes.HANDLE]
-    SetConsoleActiveScreenBuffer_Fn.restype = ctypes.wintypes.BOOL
+SetConsoleActiveScreenBuffer_Fn = kernel32.SetConsoleActiveScreenBuffer
+SetConsoleActiveScreenBuffer_Fn.argtypes = [
+        ctypes.wintypes.HANDLE]
+SetConsoleActiveScreenBuffer_Fn.restype = ctypes.wintypes.BOOL
+
 
+def SetConsoleActiveScreenBuffer(hConsoleOutput):
     return SetConsoleActiveScreenBuffer_Fn(hConsoleOutput)
 
 
-def CloseHandle(hObject):
-    CloseHandle_Fn = ctypes.windll.kernel32.CloseHandle
-    CloseHandle_Fn.argtypes = [
-            ctypes.wintypes.HANDLE]
-    CloseHandle_Fn.restype = ctypes.wintypes.BOOL
+CloseHandle_Fn = kernel32.CloseHandle
+CloseHandle_Fn.argtypes = [
+        ctypes.wintypes.HANDLE]
+CloseHandle_Fn.restype = ctypes.wintypes.BOOL
+
 
+def CloseHandle(hObject):
     return CloseHandle_Fn(hObject)
 
 
-def GetConsoleScreenBufferInfo(hConsoleOutput):
-    GetConsoleScreenBufferInfo_Fn = ctypes.windll.kernel32.GetConsoleScreenBufferInfo
-    GetConsoleScreenBufferInfo_Fn.argtypes = [
-            ctypes.wintypes.HANDLE,
-            ctypes.POINTER(CONSOLE_SCREEN_BUFFER_INFO)]
-    GetConsoleScreenBufferInfo_Fn.restype = ctypes.wintypes.BOOL
+GetConsoleScreenBufferInfo_Fn = kernel32.GetConsoleScreenBufferInfo
+GetConsoleScreenBufferInfo_Fn.argtypes = [
+        ctypes.wintypes.HANDLE,
+        ctypes.POINTER(CONSOLE_SCREEN_BUFFER_INFO)]
+GetConsoleScreenBufferInfo_Fn.restype = ctypes.wintypes.BOOL
+
 
+def GetConsoleScreenBufferInfo(hConsoleOutput):
     csbi = CONSOLE_SCREEN_BUFFER_INFO()
 
     return csbi if GetConsoleScreenBufferInfo_Fn(hConsoleOutput, ctypes.byref(csbi)) else None
 
 
-def SetConsoleScreenBufferSize(hConsoleOutput, num_columns, num_rows):
-    SetConsoleScreenBufferSize_Fn = ctypes.windll.kernel32.SetConsoleScreenBufferSize
-    SetConsoleScreenBufferSize_Fn.argtypes = [
-            ctypes.wintypes.HANDLE,
-            COORD]
-    SetConsoleScreenBufferSize_Fn.restype = ctypes.wintypes.BOOL
+SetConsoleScreenBufferSize_Fn = kernel32.SetConsoleScreenBufferSize
+SetConsoleScreenBufferSize_Fn.argtypes = [
+        ctypes.wintypes.HANDLE,
+        COORD]
+SetConsoleScreenBufferSize_Fn.restype = ctypes.wintypes.BOOL
+
 
+def SetConsoleScreenBufferSize(hConsoleOutput, num_columns, num_rows):
     return SetConsoleScreenBufferSize_Fn(hConsoleOutput, COORD(num_columns, num_rows))
 
 
@@ -326,50 +334,62 @@ class CHAR_INFO(ctypes.Structure):
     ]
 
 
+ReadConsoleOutput_Fn = kernel32.ReadConsoleOutputW
+ReadConsoleOutput_Fn.argtypes = [
+        ctypes.wintypes.HANDLE,
+        ctypes.wintypes.LPVOID,         # CHAR_INFO array of any size, passed by reference
+        COORD,
+        COORD,
+        ctypes.POINTER(SMALL_RECT)]
+ReadConsoleOutput_Fn.restype = ctypes.wintypes.BOOL
+
+
 def ReadConsoleOutput(hConsoleOutput, num_columns, num_rows):
     CONSOLE_BUFFER = (CHAR_INFO * num_columns) * num_rows
 
-    ReadConsoleOutput_Fn = ctypes.windll.kernel32.ReadConsoleOutputW
-    ReadConsoleOutput_Fn.argtypes = [
-            ctypes.wintypes.HANDLE,
-            ctypes.POINTER(CONSOLE_BUFFER),
-            COORD,
-            COORD,
-            ctypes.POINTER(SMALL_RECT)]
-    ReadConsoleOutput.restype = ctypes.wintypes.BOOL
-
     Buffer = CONSOLE_BUFFER()
-    ReadRegion = SMALL_RECT(0, 0, num_columns-1, num_rows-1)
+    BufferSize = COORD(num_columns, num_rows)
+    stripe_rows = max(1, MAX_READ_CONSOLE_CELLS // num_columns)
 
-    return Buffer if ReadConsoleOutput_Fn(
-            hConsoleOutput,
-            ctypes.byref(Buffer),
-            COORD(num_columns, num_rows),
-            COORD(0, 0),
-            ctypes.byref(ReadRegion)) else None
+    for top in range(0, num_rows, stripe_rows):
+        bottom = min(top + stripe_rows, num_rows) - 1
+        ReadRegion = SMALL_RECT(0, top, num_columns-1, bottom)
 
+        if not ReadConsoleOutput_Fn(
+                hConsoleOutput,
+                ctypes.byref(Buffer),
+                BufferSize,
+                COORD(0, top),
+                ctypes.byref(ReadRegion)):
+            return None
+
+    return Buffer
+
+
+AllocConsole_Fn = kernel32.AllocConsole
+AllocConsole_Fn.argtypes = []
+AllocConsole_Fn.restype = ctypes.wintypes.BOOL
 
-def AllocConsole():
-    AllocConsole_Fn = ctypes.windll.kernel32.AllocConsole
-    AllocConsole_Fn.argtypes = []
-    AllocConsole.restype = ctypes.wintypes.BOOL
 
+def AllocConsole():
     return AllocConsole_Fn()
 
 
-def FreeConsole():
-    FreeConsole_Fn = ctypes.windll.kernel32.FreeConsole
-    FreeConsole_Fn.argtypes = []
-    FreeConsole_Fn.restype = ctypes.wintypes.BOOL
+FreeConsole_Fn = kernel32.FreeConsole
+FreeConsole_Fn.argtypes = []
+FreeConsole_Fn.restype = ctypes.wintypes.BOOL
+
 
+def FreeConsole():
     return FreeConsole_Fn()
 
 
-def GetLastError():
-    GetLastError_Fn = ctypes.windll.kernel32.GetLastError
-    GetLastError_Fn.argtypes = []
-    GetLastError_Fn.restype = ctypes.wintypes.DWORD
+GetLastError_Fn = kernel32.GetLastError
+GetLastError_Fn.argtypes = []
+GetLastError_Fn.restype = ctypes.wintypes.DWORD
 
+
+def GetLastError():
     return GetLastError_Fn()
 
 
@@ -389,16 +409,17 @@ class SECURITY_ATTRIBUTES(ctypes.Structure):
     ]
 
 
-def CreateConsoleScreenBuffer(dwDesiredAccess=GENERIC_READ | GENERIC_WRITE, dwShareMode=FILE_SHARE_READ | FILE_SHARE_WRITE):
-    CreateConsoleScreenBuffer_Fn = ctypes.windll.kernel32.CreateConsoleScreenBuffer
-    CreateConsoleScreenBuffer_Fn.argtypes = [
-            DWORD,
-            DWORD,
-            ctypes.POINTER(SECURITY_ATTRIBUTES),
-            DWORD,
-            ctypes.wintypes.LPVOID]
-    CreateConsoleScreenBuffer_Fn.restype = ctypes.wintypes.HANDLE
+CreateConsoleScreenBuffer_Fn = kernel32.CreateConsoleScreenBuffer
+CreateConsoleScreenBuffer_Fn.argtypes = [
+        DWORD,
+        DWORD,
+        ctypes.POINTER(SECURITY_ATTRIBUTES),
+        DWORD,
+        ctypes.wintypes.LPVOID]
+CreateConsoleScreenBuffer_Fn.restype = ctypes.wintypes.HANDLE
 
+
+def CreateConsoleScreenBuffer(dwDesiredAccess=GENERIC_READ | GENERIC_WRITE, dwShareMode=FILE_SHARE_READ | FILE_SHARE_WRITE):
     SecurityAttributes = SECURITY_ATTRIBUTES(ctypes.sizeof(SECURITY_ATTRIBUTES), None, True)
 
     return CreateConsoleScreenBuffer_Fn(
@@ -409,21 +430,23 @@ def CreateConsoleScreenBuffer(dwDesiredAccess=GENERIC_READ | GENERIC_WRITE, dwSh
             None)
 
 
-def GetConsoleWindow():
-    GetConsoleWindow_Fn = ctypes.windll.kernel32.GetConsoleWindow
-    GetConsoleWindow_Fn.argtypes = []
-    GetConsoleWindow_Fn.restype = ctypes.wintypes.HANDLE
+GetConsoleWindow_Fn = kernel32.GetConsoleWindow
+GetConsoleWindow_Fn.argtypes = []
+GetConsoleWindow_Fn.restype = ctypes.wintypes.HANDLE
 
+
+def GetConsoleWindow():
     return GetConsoleWindow_Fn()
 
 
-def ShowWindow(hWnd, nCmdShow):
-    ShowWindow_Fn = ctypes.windll.user32.ShowWindow
-    ShowWindow_Fn.argtypes = [
-            ctypes.wintypes.HANDLE,
-            DWORD]
-    ShowWindow_Fn.restype = ctypes.wintypes.BOOL
+ShowWindow_Fn = user32.ShowWindow
+ShowWindow_Fn.argtypes = [
+        ctypes.wintypes.HANDLE,
+        DWORD]
+ShowWindow_Fn.restype = ctypes.wintypes.BOOL
 
+
+def ShowWindow(hWnd, nCmdShow):
     return ShowWindow_Fn(hWnd, nCmdShow)
 
 
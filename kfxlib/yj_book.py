@@ -8,9 +8,7 @@ from .ion_symbol_table import (LocalSymbolTable, SymbolTableCatalog)
 from .ion_text import IonText
 from .kfx_container import (KfxContainer, MAX_KFX_CONTAINER_SIZE)
 from .kpf_book import KpfBook
-from .kpf_container import KpfContainer
 from .message_logging import log
-from .unpack_container import (IonTextContainer, JsonContentContainer, ZipUnpackContainer)
 from .utilities import (
         DataFile, file_read_utf8, flush_unicode_cache, bytes_to_separated_hex, KFXDRMError,
         temp_file_cleanup, ZIP_SIGNATURE)
@@ -30,6 +28,14 @@ __license__ = "GPL v3"
 __copyright__ = "2021, John Howell <jhowell@acm.org>"
 
 
+MAX_SIGNATURE_CHECK_LEN = 0x3c + 8      # through the MOBI type at offset 0x3c
+
+CONTAINER_FILE_EXTS = frozenset([".azw", ".azw8", ".azw9", ".kfx", ".md", ".res", ".yj"])
+SINGLE_CONTAINER_FILE_EXTS = frozenset([".azw8", ".ion", ".kfx", ".kpf"])
+ZIP_FILE_EXTS = frozenset([".kfx-zip", ".zip"])
+UNPACKED_BOOK_FILENAMES = frozenset(["book.ion", "book.kdf"])
+
+
 class YJ_Book(BookStructure, BookPosLoc, BookMetadata, KpfBook):
     def __init__(self, file, credentials=[], is_netfs=False):
         self.datafile = DataFile(file)
@@ -151,7 +157,7 @@ class YJ_Book(BookStructure, BookPosLoc, BookMetadata, KpfBook):
         self.final_actions(do_symtab_report=False)
         return self.get_yj_metadata_from_book()
 
-    def convert_to_kpf(self, conversion=None, flags=None, timeout_sec=None, cleaned_filename=None):
+    def convert_to_kpf(self, conversion=None, flags=None, timeout_sec=None, cleaned_filename=None, kpf_filename=None):
         from .generate_kpf_common import ConversionResult
         from .generate_kpf_using_cli import KPR_CLI
 
@@ -178,7 +184,7 @@ class YJ_Book(BookStructure, BookPosLoc, BookMetadata, KpfBook):
             return ConversionResult(error_msg="Cannot generate KPF from %s file using %s" % (intype, conversion_name))
 
         try:
-            result = conversion_sequence.convert(infile, flags, timeout_sec, cleaned_filename)
+            result = conversion_sequence.convert(infile, flags, timeout_sec, cleaned_filename, kpf_filename)
         except Exception as e:
             traceback.print_exc()
             result = ConversionResult(error_msg=repr(e))
@@ -187,12 +193,14 @@ class YJ_Book(BookStructure, BookPosLoc, BookMetadata, KpfBook):
         return result
 
     def convert_to_zip_unpack(self):
+        from .unpack_container import ZipUnpackContainer
         self.decode_book()
         result = ZipUnpackContainer(self.symtab, fragments=self.fragments).serialize()
         self.final_actions()
         return result
 
     def convert_to_json_content(self):
+        from .unpack_container import JsonContentContainer
         self.decode_book()
         result = JsonContentContainer(self).serialize()
         self.final_actions()
@@ -245,11 +253,12 @@ class YJ_Book(BookStructure, BookPosLoc, BookMetadata, KpfBook):
 
     def locate_book_datafiles(self):
         self.container_datafiles = []
+        self.unpacked_book_filenames = {}      # zip datafile name --> book.ion/book.kdf member name
 
         if self.datafile.is_real_file and os.path.isdir(self.datafile.name):
             self.locate_files_from_dir(self.datafile.name)
 
-        elif self.datafile.ext in [".azw8", ".ion", ".kfx", ".kpf"]:
+        elif self.datafile.ext in SINGLE_CONTAINER_FILE_EXTS:
 
             self.container_datafiles.append(self.datafile)
 
@@ -258,15 +267,20 @@ class YJ_Book(BookStructure, BookPosLoc, BookMetadata, KpfBook):
                 if os.path.isdir(sdr_dirname):
                     self.locate_files_from_dir(sdr_dirname)
 
-        elif self.datafile.ext in [".kfx-zip", ".zip"]:
+        elif self.datafile.ext in ZIP_FILE_EXTS:
             with self.datafile.as_ZipFile() as zf:
+                container_infos = []
                 for info in zf.infolist():
-                    if posixpath.basename(info.filename) in ["book.ion", "book.kdf"]:
+                    if posixpath.basename(info.filename) in UNPACKED_BOOK_FILENAMES:
                         self.container_datafiles.append(self.datafile)
+                        self.unpacked_book_filenames[self.datafile.name] = info.filename
                         break
+
+                    if self.is_container_filename(info.filename):
+                        container_infos.append(info)
                 else:
-                    for info in zf.infolist():
-                        self.check_located_file(info.filename, zf.read(info), self.datafile)
+                    for info in container_infos:
+                        self.container_datafiles.append(DataFile(info.filename, zf.read(info), self.datafile))
 
         else:
             raise Exception("Unknown main file type. Must be azw8, ion, kfx, kfx-zip, kpf, or zip.")
@@ -283,26 +297,43 @@ class YJ_Book(BookStructure, BookPosLoc, BookMetadata, KpfBook):
                     self.check_located_file(os.path.join(dirpath, fn))
 
     def check_located_file(self, name, data=None, parent=None):
+        if self.is_container_filename(name):
+            self.container_datafiles.append(DataFile(name, data, parent))
+
+    def is_container_filename(self, name):
         basename = posixpath.basename(name.replace("\\", "/"))
         ext = os.path.splitext(basename)[1]
 
-        if ext in [".azw", ".azw8", ".azw9", ".kfx", ".md", ".res", ".yj"]:
-            self.container_datafiles.append(DataFile(name, data, parent))
+        return ext in CONTAINER_FILE_EXTS
 
     def get_container(self, datafile, ignore_drm=False):
+        from .kpf_container import KpfContainer
+        from .unpack_container import (IonTextContainer, ZipUnpackContainer)
+
         if datafile.ext == ".ion":
             return IonTextContainer(self.symtab, datafile)
 
-        data = datafile.get_data()
+        if datafile.ext == ".kpf":
+            # KpfContainer always opens a .kpf file as a zip and locates its KDF itself
+            return KpfContainer(self.symtab, datafile, book=self)
+
+        data = datafile.peek_data(MAX_SIGNATURE_CHECK_LEN)
 
         if data.startswith(ZIP_SIGNATURE):
-            with datafile.as_ZipFile() as zf:
-                for info in zf.infolist():
-                    if posixpath.basename(info.filename) in ["book.ion", "book.kdf"]:
-                        if info.filename.endswith(".kdf"):
-                            return KpfContainer(self.symtab, datafile, book=self)
-                        else:
-                            return ZipUnpackContainer(self.symtab, datafile)
+            unpacked_book_filename = self.unpacked_book_filenames.get(datafile.name)
+
+            if unpacked_book_filename is None:
+                with datafile.as_ZipFile() as zf:
+                    for info in zf.infolist():
+                        if posixpath.basename(info.filename) in UNPACKED_BOOK_FILENAMES:
+                            unpacked_book_filename = info.filename
+                            break
+
+            if unpacked_book_filename is not None:
+                if unpacked_book_filename.endswith(".kdf"):
+                    return KpfContainer(self.symtab, datafile, book=self)
+                else:
+                    return ZipUnpackContainer(self.symtab, datafile)
 
         if data.startswith(KpfContainer.KDF_SIGNATURE):
             return KpfContainer(self.symtab, datafile, book=self)
@@ -9,8 +9,10 @@ __license__ = "GPL v3"
 __copyright__ = "2021, John Howell <jhowell@acm.org>"
 
 
-ASIN_RE = r"^B[0-9A-Z]{9}$"
+ASIN_RE = re.compile(r"B[0-9A-Z]{9}\Z")
 AUTO_PAGES = "(auto)"           # fake name for automatic page number generation, instead of a lookup name
+HAVE_STR_ISASCII = sys.version_info >= (3, 7)
+USER_ANNOTATION_MARKERS = ('<div class="user_annotations">', '<hr class="annotations_divider" />')
 
 if sys.version_info[0] == 2:
     str = type("")
@@ -23,7 +25,7 @@ class KFXMetadataWriter(MetadataWriterPlugin):
     author = "jhowell"
 
     def set_metadata(self, stream, mi, type_):
-        from calibre_plugins.kfx_output.kfxlib import (set_logger, YJ_Book, YJ_Metadata)
+        from calibre_plugins.kfx_output.kfxlib import (file_read_binary, set_logger, YJ_Book, YJ_Metadata)
         from calibre.ebooks import normalize as normalize_unicode
         from calibre.ebooks.metadata import author_to_author_sort
         from calibre.utils.config_base import tweaks
@@ -31,18 +33,18 @@ class KFXMetadataWriter(MetadataWriterPlugin):
         from calibre.utils.logging import Log
         from calibre.utils.localization import (canonicalize_lang, lang_as_iso639_1)
 
-        def mapped_author_to_author_sort(author):
-            if hasattr(mi, "author_sort_map"):
-                author_sort = mi.author_sort_map.get(author)    # use mapping if provided
-                if author_sort:
-                    return author_sort
+        author_sort_map = getattr(mi, "author_sort_map", None) or {}
 
-            return author_to_author_sort(author)
+        def mapped_author_to_author_sort(author):
+            return author_sort_map.get(author) or author_to_author_sort(author)     # use mapping if provided
 
         def normalize(s):
-            if not isinstance(s, type("")):
+            if not isinstance(s, str):
                 s = s.decode("utf8", "ignore")
 
+            if HAVE_STR_ISASCII and s.isascii():
+                return s        # ASCII text is unchanged by Unicode normalization
+
             return normalize_unicode(s)
 
         log = set_logger(Log())
@@ -70,14 +72,14 @@ class KFXMetadataWriter(MetadataWriterPlugin):
             md.issue_date = str(isoformat(mi.pubdate)[:10])
 
         if mi.comments:
-            # Strip user annotations
-            a_offset = mi.comments.find('<div class="user_annotations">')
-            ad_offset = mi.comments.find('<hr class="annotations_divider" />')
+            # Strip user annotations, starting from the earliest marker. Each search stops where the previous match began.
+            annotations_offset = len(mi.comments)
+            for marker in USER_ANNOTATION_MARKERS:
+                offset = mi.comments.find(marker, 0, annotations_offset)
+                if offset >= 0:
+                    annotations_offset = offset
 
-            if a_offset >= 0:
-                mi.comments = mi.comments[:a_offset]
-            if ad_offset >= 0:
-                mi.comments = mi.comments[:ad_offset]
+            mi.comments = mi.comments[:annotations_offset]
 
             md.description = normalize(mi.comments)
 
@@ -90,21 +92,13 @@ class KFXMetadataWriter(MetadataWriterPlugin):
         if mi.cover_data[1]:
             md.cover_image_data = mi.cover_data
         elif mi.cover:
-            md.cover_image_data = ("jpg", open(mi.cover, 'rb').read())
+            md.cover_image_data = ("jpg", file_read_binary(mi.cover))
 
         if not tweaks.get("kfx_output_ignore_asin_metadata", False):
-            value = mi.identifiers.get("mobi-asin")
-            if value is not None and re.match(ASIN_RE, value):
-                md.asin = value
-            else:
-                for ident, value in mi.identifiers.items():
-                    if ident.startswith("amazon") and re.match(ASIN_RE, value):
-                        md.asin = value
-                        break
-                else:
-                    value = mi.identifiers.get("asin")
-                    if value is not None and re.match(ASIN_RE, value):
-                        md.asin = value
+            for value in asin_candidates(mi.identifiers):
+                if value and ASIN_RE.match(value):
+                    md.asin = value
+                    break
 
         if md.asin:
             md.cde_content_type = "EBOK"
@@ -127,6 +121,17 @@ class KFXMetadataWriter(MetadataWriterPlugin):
         set_logger()
 
         stream.seek(0)
-        stream.truncate()
         stream.write(new_data)
+        stream.truncate()
         stream.seek(0)
+
+
+def asin_candidates(identifiers):
+    # identifier values that may hold the book's ASIN, in order of preference
+    yield identifiers.get("mobi-asin")
+
+    for ident, value in identifiers.items():
+        if ident.startswith("amazon"):
+            yield value
+
+    yield identifiers.get("asin")
@@ -58,7 +58,7 @@ class PluginWidget(Widget):
         self.opt_number_of_pages_field.setObjectName("opt_number_of_pages_field")
         self.opt_number_of_pages_field.setEditable(True)
 
-        labels = set()
+        lookup_names = [AUTO_PAGES]
         db = self.db
 
         if db is None:
@@ -66,11 +66,9 @@ class PluginWidget(Widget):
             db = get_gui().current_db
 
         if db is not None:
-            for lbl in db.custom_column_label_map:
-                labels.add("#" + lbl)
+            lookup_names.extend(sorted("#" + lbl for lbl in db.custom_column_label_map))     # labels are unique map keys
 
-        for cc in [AUTO_PAGES] + sorted(list(labels)):
-            self.opt_number_of_pages_field.addItem(cc)
+        self.opt_number_of_pages_field.addItems(lookup_names)
 
         self.opt_number_of_pages_field.setCurrentIndex(0)
         self.formLayout.addRow("               Lookup name of custom column with desired number of pages:", self.opt_number_of_pages_field)